@@ -7,6 +7,9 @@
 # License: BSD (3-clause)
 import time
 import copy
+import queue
+import threading
+import weakref
 
 import numpy as np
 
@@ -15,6 +18,79 @@ from mne.io.pick import _picks_to_idx
 from mne.utils import logger, verbose, fill_doc, warn
 from mne.epochs import BaseEpochs
 from mne.event import _find_events
+from mne.fixes import jit, has_numba
+
+# maximum number of picks kept in the cache of RtEpochs._get_data
+_MAX_PICKS_CACHE = 32
+
+
+@jit()
+def _find_onsets(data, first_samp, mask):
+    """Find the increasing onsets in a single stim channel.
+
+    This is equivalent to (but much faster than) calling ``_find_events``
+    with ``output='onset'``, ``consecutive='increasing'``,
+    ``min_samples=0`` and ``mask_type='not_and'``, including taking the
+    absolute value of negative trigger values.
+    """
+    not_mask = ~mask
+    n_times = data.shape[1]
+    n_events = 0
+    for ii in range(1, n_times):
+        if (abs(data[0, ii]) & not_mask) > (abs(data[0, ii - 1]) & not_mask):
+            n_events += 1
+    events = np.empty((n_events, 3), dtype=np.int64)
+    n_events = 0
+    for ii in range(1, n_times):
+        prev = abs(data[0, ii - 1]) & not_mask
+        cur = abs(data[0, ii]) & not_mask
+        if cur > prev:
+            events[n_events, 0] = first_samp + ii
+            events[n_events, 1] = prev
+            events[n_events, 2] = cur
+            n_events += 1
+    return events
+
+
+def _raw_buffer_worker(epochs_ref, raw_q):
+    """Worker thread that processes the received raw buffers.
+
+    Only a weak reference to the epochs is kept between buffers so that
+    epochs that are never stopped can be garbage collected.
+    """
+    while True:
+        raw_buffer = raw_q.get()
+        if raw_buffer is None:  # stop() was called or epochs were collected
+            break
+        epochs = epochs_ref()
+        if epochs is None:
+            break
+        try:
+            epochs._process_raw_buffer(raw_buffer)
+        except Exception as err:
+            # the sample counting is off from now on, do not go on with it
+            logger.exception('Raw buffer worker stopped: %s' % err)
+            with epochs._cv:
+                epochs._worker_error = err
+                epochs._started = False
+                epochs._cv.notify_all()
+            break
+        del epochs
+
+
+def _append_row(arr, n_rows, row):
+    """Write row at index n_rows of arr, doubling its capacity if needed.
+
+    Returns the (possibly reallocated) array.
+    """
+    if n_rows == len(arr):
+        new_arr = np.empty((max(2 * n_rows, 8),) + np.shape(row),
+                           dtype=arr.dtype)
+        if n_rows > 0:
+            new_arr[:n_rows] = arr[:n_rows]
+        arr = new_arr
+    arr[n_rows] = row
+    return arr
 
 
 @fill_doc
@@ -51,8 +127,8 @@ class RtEpochs(BaseEpochs):
         Name of the stim channel or all the stim channels affected by
         the trigger.
     sleep_time : float
-        Time in seconds to wait between checking for new epochs when epochs
-        are requested and the receive queue is empty.
+        Not used anymore, waiting for new epochs is notified as soon as they
+        are received. Kept for backward compatibility.
     baseline : None (default) or tuple of length 2
         The time interval to apply baseline correction.
         If None do not apply it. If baseline is (a, b)
@@ -148,14 +224,30 @@ class RtEpochs(BaseEpochs):
 
         # FIFO queues for received epochs and events
         # need to be initialized to validate invariants in base constructor
-        self._epoch_queue = list()
-        self._events = list()
+        # the epochs are stored in an array of shape (capacity, nchan, n_times)
+        # of which the first self._n_queue are valid
+        self._epoch_arr = np.empty((0, 0, 0))
+        self._n_queue = 0
+        self._events_arr = np.empty((0, 3), dtype=np.int64)
+        self._n_events = 0
         self._selection = list()
+        self._drop_log = list()
 
         # Number of good and bad epochs received
         self._n_good = 0
         self._n_bad = 0
 
+        # notified whenever an epoch is added to the queue, also protects
+        # the queue as epochs are added by the worker thread (needed by
+        # decimate, which is called by the base constructor)
+        self._cv = threading.Condition()
+
+        # raw buffers received from the client, processed by a worker thread
+        self._raw_q = queue.Queue()
+        self._worker = None
+        self._worker_finalizer = None
+        self._worker_error = None
+
         # call BaseEpochs constructor
         super(RtEpochs, self).__init__(
             info, None, None, event_id, tmin, tmax, baseline, picks=picks,
@@ -176,7 +268,10 @@ class RtEpochs(BaseEpochs):
             raise ValueError('No stim channel found to extract event '
                              'triggers.')
 
-        self._stim_picks = stim_picks
+        # an array (not a scalar) so that indexing always gives 2D data
+        self._stim_picks = np.asarray(stim_picks, dtype=np.intp)
+        self._event_id_arr = np.fromiter(self.event_id.values(),
+                                         dtype=np.int64)
 
         # find_events default options
         self._find_events_kwargs = dict(output='onset',
@@ -192,29 +287,62 @@ class RtEpochs(BaseEpochs):
         self._find_events_kwargs.pop('min_duration', None)
         self._find_events_kwargs['min_samples'] = min_samples
 
-        self._sleep_time = sleep_time
+        # the default options on a single stim channel are handled by a
+        # compiled kernel if numba is available
+        mask = self._find_events_kwargs['mask']
+        mask = 0 if mask is None else mask
+        self._fast_onsets = (
+            has_numba and len(stim_picks) == 1 and
+            isinstance(mask, (int, np.integer)) and
+            set(self._find_events_kwargs) == {
+                'output', 'consecutive', 'min_samples', 'mask', 'mask_type',
+                'verbose'} and
+            self._find_events_kwargs['output'] == 'onset' and
+            self._find_events_kwargs['consecutive'] == 'increasing' and
+            self._find_events_kwargs['min_samples'] == 0 and
+            self._find_events_kwargs['mask_type'] == 'not_and')
+        self._onsets_mask = np.int64(mask) if self._fast_onsets else None
 
         # add calibration factors
-        cals = np.zeros(self._client_info['nchan'])
-        for k in range(self._client_info['nchan']):
-            cals[k] = (self._client_info['chs'][k]['range'] *
-                       self._client_info['chs'][k]['cal'])
-        self._cals = cals[:, None]
-
-        # variables needed for receiving raw buffers
-        self._last_buffer = None
+        chs, nchan = self._client_info['chs'], self._client_info['nchan']
+        ranges = np.fromiter((ch['range'] for ch in chs), dtype=np.float64,
+                             count=nchan)
+        cals = np.fromiter((ch['cal'] for ch in chs), dtype=np.float64,
+                           count=nchan)
+        self._cals = (ranges * cals)[:, None]
+        self._cals.setflags(write=False)
+
+        # variables needed for receiving raw buffers, the last buffer is
+        # allocated once the size of the incoming buffers is known
+        self._last_buffer = np.zeros((self._client_info['nchan'], 0))
+        self._last_buf_fill = 0
+        self._stim_scratch = np.empty((len(self._stim_picks), 0),
+                                      dtype=np.int64)
+        self._cal_scratch = np.empty((self._client_info['nchan'], 0))
         self._first_samp = 0
         self._event_backlog = list()
 
         self._started = False
         self._last_time = time.time()
 
+        # picks indices already resolved in _get_data, valid for the channel
+        # names and types they were resolved with
+        self._picks_cache = dict()
+        self._picks_cache_chs = None
+
+        # scratch buffers and cached parameters used by _process_epoch
+        self._epoch_scratch = np.empty((0, 0))
+        self._proj_scratch = np.empty((0, 0))
+        self._baseline_params = (None, None, None, None)
+        self._reject_params = (None, None, None)
+        self._proj_params = (None, None, None)
+
         self.isi_max = isi_max
 
     @property
     def events(self):
         """The events associated with the epochs currently in the queue."""
-        return np.array(self._events)
+        return self._events_arr[:self._n_events]
 
     @events.setter
     def events(self, new_events):
@@ -226,8 +354,8 @@ class RtEpochs(BaseEpochs):
         new_events : array of int, shape (n_events, 3)
             new events
         """
-        self._events = [tuple(new_events[i, :])
-                        for i in range(len(new_events))]
+        self._events_arr = np.array(new_events, dtype=np.int64).reshape(-1, 3)
+        self._n_events = len(self._events_arr)
 
     @property
     def selection(self):
@@ -246,29 +374,52 @@ class RtEpochs(BaseEpochs):
         """
         self._selection = list(new_selection)
 
+    @property
+    def drop_log(self):
+        """Tuple of tuple of str giving the reasons for dropping epochs."""
+        return tuple(self._drop_log)
+
+    @drop_log.setter
+    def drop_log(self, new_drop_log):
+        """
+        Update the internal drop log list.
+
+        Parameters
+        ----------
+        new_drop_log : iterable of tuple of str
+
+        """
+        self._drop_log = list(new_drop_log)
+
     def copy(self):
         """Return copy of Epochs instance."""
-        client = self._client
-        del self._client
-        new = super(RtEpochs, self).copy()
-        self._client = client
-        new._client = client
+        # the client is shared and the threading objects are not copied
+        memo = {id(self._client): self._client,
+                id(self._cv): threading.Condition(),
+                id(self._raw_q): queue.Queue(),
+                id(self._worker): None,
+                id(self._worker_finalizer): None}
+        with self._cv:
+            new = copy.deepcopy(self, memo)
+        new._picks_cache = dict()
         return new
 
     def _getitem(self, item, reason='IGNORED', copy=True, drop_event_id=True,
                  select_data=True, return_indices=False):
 
-        epochs, select = super(RtEpochs, self)._getitem(
-            item=item, reason=reason, copy=copy, drop_event_id=drop_event_id,
-            select_data=False, return_indices=True)
+        with self._cv:
+            epochs, select = super(RtEpochs, self)._getitem(
+                item=item, reason=reason, copy=copy,
+                drop_event_id=drop_event_id, select_data=False,
+                return_indices=True)
 
-        # try to be compatible with numpy indexing
-        new_queue = list()
-        for kept_idx in np.arange(len(epochs._epoch_queue), dtype=int)[select]:
-            new_queue.append(epochs._epoch_queue[kept_idx])
-        epochs._epoch_queue = new_queue
+            # try to be compatible with numpy indexing
+            kept_idx = np.arange(epochs._n_queue, dtype=int)[select]
+            epochs._epoch_arr = epochs._epoch_arr[kept_idx]
+            epochs._n_queue = len(kept_idx)
 
-        epochs._n_good = len(epochs._epoch_queue)
+        epochs._n_good = epochs._n_queue
+        epochs._picks_cache = dict()
 
         return epochs
 
@@ -278,8 +429,26 @@ class RtEpochs(BaseEpochs):
         The measurement will be started if it has not already been started.
         """
         if not self._started:
+            if self._fast_onsets:
+                # compile (or load from the numba cache) the onset kernel now
+                # rather than when the first buffer arrives
+                _find_onsets(np.zeros((1, 2), dtype=np.int64), 0,
+                             self._onsets_mask)
+
+            # start the worker processing the received buffers, with a new
+            # queue so that no buffer left over from a previous run is used
+            self._raw_q = queue.Queue()
+            self._worker = threading.Thread(
+                target=_raw_buffer_worker,
+                args=(weakref.ref(self), self._raw_q))
+            self._worker.daemon = True
+            self._worker.start()
+            # stop the worker if the epochs are collected without stop()
+            self._worker_finalizer = weakref.finalize(
+                self, self._raw_q.put, None)
+
             # register the callback
-            self._client.register_receive_callback(self._process_raw_buffer)
+            self._client.register_receive_callback(self._enqueue_raw_buffer)
 
             # start the measurement and the receive thread
             nchan = self._client_info['nchan']
@@ -301,9 +470,19 @@ class RtEpochs(BaseEpochs):
             Also stop the measurement. Note: Other clients attached to the
             server will also stop receiving data.
         """
-        if self._started:
-            self._client.unregister_receive_callback(self._process_raw_buffer)
-            self._started = False
+        # the worker clears _started if it failed, it still has to be joined
+        if self._started or self._worker is not None:
+            self._client.unregister_receive_callback(self._enqueue_raw_buffer)
+            # let the worker process the buffers received so far
+            if self._worker is not None:
+                self._worker_finalizer.detach()
+                self._raw_q.put(None)
+                if self._worker is not threading.current_thread():
+                    self._worker.join()
+                self._worker = self._worker_finalizer = None
+            with self._cv:
+                self._started = False
+                self._cv.notify_all()
 
         if stop_receive_thread or stop_measurement:
             self._client.stop_receive_thread(stop_measurement=stop_measurement)
@@ -328,25 +507,30 @@ class RtEpochs(BaseEpochs):
             The event id. Only returned if ``return_event_id`` is ``True``.
         """
         first = True
-        while True:
-            current_time = time.time()
-            if len(self._epoch_queue) > self._current:
-                epoch = self._epoch_queue[self._current]
-                event_id = self._events[self._current][-1]
-                self._current += 1
-                self._last_time = current_time
-                return (epoch, event_id) if return_event_id else epoch
-            if current_time > (self._last_time + self.isi_max):
-                logger.info('Time of %s seconds exceeded.' % self.isi_max)
-                raise StopIteration  # signal the end properly
-            if self._started:
-                if first:
-                    logger.info('Waiting for epoch %d' % (self._current + 1))
-                    first = False
-                time.sleep(self._sleep_time)
-            else:
-                raise RuntimeError('Not enough epochs in queue and currently '
-                                   'not receiving epochs, cannot get epochs!')
+        with self._cv:
+            while True:
+                self._check_worker_error()
+                current_time = time.time()
+                if self._n_queue > self._current:
+                    epoch = self._epoch_arr[self._current]
+                    event_id = int(self._events_arr[self._current, -1])
+                    self._current += 1
+                    self._last_time = current_time
+                    return (epoch, event_id) if return_event_id else epoch
+                if current_time > (self._last_time + self.isi_max):
+                    logger.info('Time of %s seconds exceeded.' % self.isi_max)
+                    raise StopIteration  # signal the end properly
+                if self._started:
+                    if first:
+                        logger.info('Waiting for epoch %d'
+                                    % (self._current + 1))
+                        first = False
+                    timeout = self._last_time + self.isi_max - current_time
+                    self._cv.wait(timeout if np.isfinite(timeout) else None)
+                else:
+                    raise RuntimeError('Not enough epochs in queue and '
+                                       'currently not receiving epochs, '
+                                       'cannot get epochs!')
 
     next = __next__
 
@@ -362,15 +546,67 @@ class RtEpochs(BaseEpochs):
                      'will be ignored')
         item = slice(None) if item is None else item
         select = self._item_to_select(item)  # indices or slice
-        use_idx = np.arange(len(self._events))[select]
         if picks is None:
             picks = slice(None)
         else:
-            picks = _picks_to_idx(self.info, picks, none='all', exclude=())
-        return np.array([self._epoch_queue[idx][picks] for idx in use_idx])
+            picks = self._get_picks_idx(picks)
+        with self._cv:
+            self._check_worker_error()
+            use_idx = np.arange(self._n_queue)[select]
+            return self._epoch_arr[use_idx][:, picks]
+
+    def _enqueue_raw_buffer(self, raw_buffer):
+        """Queue a raw buffer for processing (callback from RtClient).
+
+        The processing is done by a worker thread, started by start(), so
+        that the receive thread is not blocked.
+
+        Parameters
+        ----------
+        raw_buffer : array of float, shape=(nchan, n_times)
+            The raw buffer.
+        """
+        if self._worker_error is None:
+            self._raw_q.put(raw_buffer)
+
+    def _check_worker_error(self):
+        """Raise the error that stopped the worker, if any."""
+        if self._worker_error is not None:
+            raise RuntimeError('Processing the received raw buffers failed, '
+                               'cannot get epochs!') from self._worker_error
+
+    def _get_picks_idx(self, picks):
+        """Convert picks to indices, caching the result."""
+        # picks by name or type resolve differently once channels are
+        # renamed, dropped or have their type changed
+        chs_key = [(ch['ch_name'], ch['kind'], ch['coil_type'])
+                   for ch in self.info['chs']]
+        if chs_key != self._picks_cache_chs:
+            self._picks_cache = dict()
+            self._picks_cache_chs = chs_key
+        if isinstance(picks, np.ndarray):
+            if picks.dtype.hasobject:  # the bytes are pointers, not values
+                key = None
+            else:
+                key = (picks.dtype.str, picks.shape, picks.tobytes())
+        elif isinstance(picks, (list, tuple)):
+            key = tuple(picks)
+        else:
+            key = picks
+        try:
+            idx = self._picks_cache.get(key)
+        except TypeError:  # not hashable
+            key = idx = None
+        if idx is None:
+            idx = _picks_to_idx(self.info, picks, none='all', exclude=())
+            if key is not None:
+                if len(self._picks_cache) >= _MAX_PICKS_CACHE:
+                    self._picks_cache.clear()
+                self._picks_cache[key] = idx
+        return idx
 
     def _process_raw_buffer(self, raw_buffer):
-        """Process raw buffer (callback from RtClient).
+        """Process raw buffer (called by the worker thread).
 
         Note: Do not print log messages during regular use. It will be printed
         asynchronously which is annoying when working in an interactive shell.
@@ -378,7 +614,7 @@ class RtEpochs(BaseEpochs):
         Parameters
         ----------
         raw_buffer : array of float, shape=(nchan, n_times)
-            The raw buffer.
+            The raw buffer. It does not need to be C-contiguous nor float64.
         """
         sfreq = self.info['sfreq']
         n_samp = len(self._raw_times)
@@ -389,23 +625,41 @@ class RtEpochs(BaseEpochs):
 
         last_samp = self._first_samp + raw_buffer.shape[1] - 1
 
-        # apply calibration without inplace modification
-        raw_buffer = self._cals * raw_buffer
-
-        # detect events
-        data = np.abs(raw_buffer[self._stim_picks]).astype(np.int64)
-        # if there is a previous buffer check the last samples from it too
-        if self._last_buffer is not None:
-            prev_data = self._last_buffer[
-                self._stim_picks, -raw_buffer.shape[1]:].astype(np.int64)
-            data = np.concatenate((prev_data, data), axis=1)
-            data = np.atleast_2d(data)
-            buff_events = _find_events(data,
-                                       self._first_samp - raw_buffer.shape[1],
-                                       **self._find_events_kwargs)
+        # apply calibration without inplace modification, the calibrated
+        # buffer is a C-contiguous float64 scratch array reused as long as the
+        # buffer size does not change (epochs and the last buffer are copies
+        # of it). This is also the only conversion of the buffer received
+        # from the client, which is usually a transposed (Fortran-ordered)
+        # and/or float32 array.
+        if self._cal_scratch.shape != raw_buffer.shape:
+            self._cal_scratch = np.empty(raw_buffer.shape)
+        raw_buffer = np.multiply(self._cals, raw_buffer,
+                                 out=self._cal_scratch)
+
+        # detect events on the calibrated stim channels, stacking the last
+        # samples of the previous buffer (if any) with the ones of this buffer
+        # into a preallocated scratch array
+        n_buffer = raw_buffer.shape[1]
+        n_prev = min(self._last_buf_fill, n_buffer)
+        n_data = n_prev + n_buffer
+        if self._stim_scratch.shape[1] < n_data:
+            self._stim_scratch = np.empty((len(self._stim_picks), n_data),
+                                          dtype=np.int64)
+        data = self._stim_scratch[:, :n_data]
+        if n_prev > 0:
+            data[:, :n_prev] = self._last_buffer[self._stim_picks, -n_prev:]
+        # copy the stim rows one at a time, fancy indexing would allocate
+        for ii, pick in enumerate(self._stim_picks):
+            np.copyto(data[ii, n_prev:], raw_buffer[pick], casting='unsafe')
+        if self._fast_onsets:
+            # the kernel takes the absolute value itself
+            buff_events = _find_onsets(data, self._first_samp - n_prev,
+                                       self._onsets_mask)
         else:
-            data = np.atleast_2d(data)
-            buff_events = _find_events(data, self._first_samp,
+            # negative trigger values are used as absolute values, for the
+            # samples of the previous buffer as well
+            np.abs(data, out=data)
+            buff_events = _find_events(data, self._first_samp - n_prev,
                                        **self._find_events_kwargs)
 
         events = self._event_backlog
@@ -414,63 +668,83 @@ class RtEpochs(BaseEpochs):
         min_event_samp = self._first_samp - \
             int(self._find_events_kwargs['min_samples'])
         if len(self._event_backlog) > 0:
-            backlog_samps = np.array(self._event_backlog)[:, 0]
-            min_event_samp = backlog_samps[-1] + 1
+            # the backlog is sorted, its last event is the latest one
+            min_event_samp = self._event_backlog[-1][0] + 1
 
         if buff_events.shape[0] > 0:
             valid_events_idx = buff_events[:, 0] >= min_event_samp
             buff_events = buff_events[valid_events_idx]
 
         # add events from this buffer to the list of events
-        # processed so far
-        for event_id in self.event_id.values():
-            idx = np.where(buff_events[:, -1] == event_id)[0]
-            events.extend(zip(list(buff_events[idx, 0]),
-                              list(buff_events[idx, -1])))
+        # processed so far, both are sorted and the events of this buffer
+        # come after the backlog so the result is sorted without merging
+        buff_events = buff_events[np.isin(buff_events[:, -1],
+                                          self._event_id_arr)]
+        events.extend(zip(buff_events[:, 0].tolist(),
+                          buff_events[:, -1].tolist()))
 
-        events.sort()
+        # start of the epochs relative to this buffer
+        start_offset = tmin_samp - self._first_samp
 
         event_backlog = list()
         for event_samp, event_id in events:
-            epoch = None
-            if (event_samp + tmin_samp >= self._first_samp and
-                    event_samp + tmax_samp <= last_samp):
-                # easy case: whole epoch is in this buffer
-                start = event_samp + tmin_samp - self._first_samp
-                stop = event_samp + tmax_samp - self._first_samp
-                epoch = raw_buffer[:, start:stop]
-            elif (event_samp + tmin_samp < self._first_samp and
-                    event_samp + tmax_samp <= last_samp):
+            start = event_samp + start_offset
+            if event_samp + tmax_samp > last_samp:
+                # we need samples from the future
+                # we will process this epoch with the next buffer
+                event_backlog.append((event_samp, event_id))
+                continue
+            if start >= 0:
+                # easy case: whole epoch is in this buffer (no copy)
+                epoch = raw_buffer[:, start:start + n_samp]
+            else:
                 # have to use some samples from previous buffer
-                if self._last_buffer is None:
+                if self._last_buf_fill == 0:
                     continue
-                n_last = self._first_samp - (event_samp + tmin_samp)
+                n_last = -start
                 n_this = n_samp - n_last
+                # samples before the start of the stream are not available
+                n_last = min(n_last, self._last_buf_fill)
                 epoch = np.c_[self._last_buffer[:, -n_last:],
                               raw_buffer[:, :n_this]]
-            elif event_samp + tmax_samp > last_samp:
-                # we need samples from the future
-                # we will process this epoch with the next buffer
-                event_backlog.append((event_samp, event_id))
-            else:
-                raise RuntimeError('Unhandled case..')
-
-            if epoch is not None:
-                self._append_epoch_to_queue(epoch, event_samp, event_id)
+            self._append_epoch_to_queue(epoch, event_samp, event_id)
 
         # set things up for processing of next buffer
         self._event_backlog = event_backlog
-        n_buffer = raw_buffer.shape[1]
-        if self._last_buffer is None:
-            self._last_buffer = raw_buffer
-        elif self._last_buffer.shape[1] <= n_samp + n_buffer:
-            self._last_buffer = np.c_[self._last_buffer, raw_buffer]
-        else:
-            # do not increase size of _last_buffer any further
-            self._last_buffer[:, :-n_buffer] = self._last_buffer[:, n_buffer:]
-            self._last_buffer[:, -n_buffer:] = raw_buffer
+        self._update_last_buffer(raw_buffer, n_samp)
         self._first_samp = self._first_samp + n_buffer
 
+    def _update_last_buffer(self, raw_buffer, n_samp):
+        """Push a (calibrated) raw buffer into the fixed-size last buffer.
+
+        The last buffer keeps the most recent ``n_samp + n_buffer`` samples,
+        the valid samples being the last ``self._last_buf_fill`` ones. It is
+        only reallocated if a buffer larger than the previous ones arrives.
+
+        Parameters
+        ----------
+        raw_buffer : array of float, shape=(nchan, n_times)
+            The calibrated raw buffer.
+        n_samp : int
+            The number of samples of an epoch.
+        """
+        n_buffer = raw_buffer.shape[1]
+        if n_buffer == 0:
+            return
+        n_keep = n_samp + n_buffer
+        if self._last_buffer.shape[1] < n_keep:
+            last_buffer = np.zeros((raw_buffer.shape[0], n_keep))
+            if self._last_buf_fill > 0:
+                last_buffer[:, -self._last_buf_fill:] = \
+                    self._last_buffer[:, -self._last_buf_fill:]
+            self._last_buffer = last_buffer
+        # drop the oldest samples without reallocating
+        last_buffer = self._last_buffer
+        last_buffer[:, :-n_buffer] = last_buffer[:, n_buffer:]
+        last_buffer[:, -n_buffer:] = raw_buffer
+        self._last_buf_fill = min(self._last_buf_fill + n_buffer,
+                                  last_buffer.shape[1])
+
     def _append_epoch_to_queue(self, epoch, event_samp, event_id):
         """Append a (raw) epoch to queue.
 
@@ -487,33 +761,184 @@ class RtEpochs(BaseEpochs):
         event_id : int
             The event ID of the epoch.
         """
-        # select the channels
-        epoch = epoch[self.picks, :]
+        if self._can_fuse():
+            epoch, is_good, offending_reasons = self._process_epoch(epoch)
+        else:
+            # select the channels
+            epoch = epoch[self.picks, :]
 
-        # Detrend, baseline correct, decimate
-        kwargs = dict()
-        try:  # Needed on MNE 0.23+
-            kwargs['picks'] = self._detrend_picks
-        except AttributeError:
-            pass
-        epoch = self._detrend_offset_decim(epoch, verbose='ERROR', **kwargs)
+            # Detrend, baseline correct, decimate
+            kwargs = dict()
+            try:  # Needed on MNE 0.23+
+                kwargs['picks'] = self._detrend_picks
+            except AttributeError:
+                pass
+            epoch = self._detrend_offset_decim(epoch, verbose='ERROR',
+                                               **kwargs)
 
-        # apply SSP
-        epoch = self._project_epoch(epoch)
+            # apply SSP
+            epoch = self._project_epoch(epoch)
 
-        # Decide if this is a good epoch
-        is_good, offending_reasons = self._is_good_epoch(epoch,
-                                                         verbose='ERROR')
+            # Decide if this is a good epoch
+            is_good, offending_reasons = self._is_good_epoch(epoch,
+                                                             verbose='ERROR')
 
         if is_good:
-            self._epoch_queue.append(epoch)
-            self._events.append((event_samp, 0, event_id))
-            self.drop_log = self.drop_log + (tuple(),)
-            self._selection.append(len(self.drop_log) - 1)
-            self._n_good += 1
+            with self._cv:
+                self._epoch_arr = _append_row(self._epoch_arr, self._n_queue,
+                                              epoch)
+                self._n_queue += 1
+                self._events_arr = _append_row(
+                    self._events_arr, self._n_events,
+                    (event_samp, 0, event_id))
+                self._n_events += 1
+                self._drop_log.append(tuple())
+                self._selection.append(len(self._drop_log) - 1)
+                self._n_good += 1
+                self._cv.notify_all()
         else:
-            self.drop_log = self.drop_log + (tuple(offending_reasons),)
-            self._n_bad += 1
+            with self._cv:
+                self._drop_log.append(tuple(offending_reasons))
+                self._n_bad += 1
+
+    def _can_fuse(self):
+        """Check if epochs can be processed by _process_epoch."""
+        if self.detrend is not None or self._do_delayed_proj:
+            return False
+        if getattr(self, '_offset', None) is not None:
+            return False
+        # callable thresholds are left to mne
+        for thresholds in (self.reject, self.flat):
+            if thresholds is not None and \
+                    any(callable(t) for t in thresholds.values()):
+                return False
+        return True
+
+    def _process_epoch(self, epoch):
+        """Pick, baseline correct, decimate, project and check an epoch.
+
+        This is the single pass equivalent of ``_detrend_offset_decim``,
+        ``_project_epoch`` and ``_is_good_epoch`` when no detrending is done.
+        Intermediate results are written in preallocated scratch buffers.
+
+        Parameters
+        ----------
+        epoch : array of float, shape=(nchan, n_times)
+            The raw epoch (only calibration has been applied) over all
+            channels.
+
+        Returns
+        -------
+        epoch : array of float, shape=(n_picks, n_times_decim)
+            The processed epoch. It is a view of a scratch buffer, i.e., it
+            needs to be copied to be kept.
+        is_good : bool
+            Whether the epoch is good.
+        offending_reasons : tuple of str | None
+            The reasons for rejecting the epoch.
+        """
+        shape = (len(self.picks), epoch.shape[1])
+        if self._epoch_scratch.shape != shape:
+            self._epoch_scratch = np.empty(shape)
+        data = self._epoch_scratch
+        # picks are valid indices, 'clip' avoids buffering the output
+        np.take(epoch, self.picks, axis=0, out=data, mode='clip')
+
+        # baseline correct, the mean is computed over all channels as done by
+        # mne.baseline.rescale so that the results are identical
+        if getattr(self, '_do_baseline', True) and \
+                self.baseline is not None:
+            imin, imax, bsl_picks = self._get_baseline_params()
+            mean = np.mean(data[:, imin:imax], axis=-1, keepdims=True)
+            if bsl_picks is None:
+                data -= mean
+            else:
+                data[bsl_picks] -= mean[bsl_picks]
+
+        # decimate
+        data = data[:, self._decim_slice]
+
+        # apply SSP
+        ptp_checked = False
+        if self._projector is not None and self.proj is True:
+            # rejected epochs do not need to be projected if the rejection
+            # only involves channels left unchanged by the projector
+            if self._reject_before_proj():
+                if not self._check_ptp(data):
+                    return (data,) + self._is_good_epoch(data,
+                                                         verbose='ERROR')
+                ptp_checked = True
+            shape = (len(self._projector), data.shape[1])
+            if self._proj_scratch.shape != shape:
+                self._proj_scratch = np.empty(shape)
+            data = np.dot(self._projector, data, out=self._proj_scratch)
+
+        # Decide if this is a good epoch, only the rejected epochs go through
+        # _is_good_epoch to get the offending channels
+        if data.shape[1] < len(self.times):
+            return (data,) + self._is_good_epoch(data, verbose='ERROR')
+        if not ptp_checked and not self._check_ptp(data):
+            return (data,) + self._is_good_epoch(data, verbose='ERROR')
+        return data, True, None
+
+    def _check_ptp(self, data):
+        """Check the peak-to-peak amplitudes against reject and flat."""
+        if self.reject is None and self.flat is None:
+            return True
+        reject_vec, flat_vec = self._get_reject_params()
+        reject_time = (slice(None) if self._reject_time is None else
+                       self._reject_time)
+        ptp = np.ptp(data[:, reject_time], axis=1)
+        return not (np.any(ptp > reject_vec) or np.any(ptp < flat_vec))
+
+    def _reject_before_proj(self):
+        """Check if only channels unchanged by the projector are checked."""
+        if self.reject is None and self.flat is None:
+            return False
+        reject_vec, flat_vec = self._get_reject_params()
+        if self._proj_params[0] is not self._projector or \
+                self._proj_params[1] is not reject_vec:
+            projector = self._projector
+            unprojected = np.all(projector == np.eye(len(projector)), axis=1)
+            checked = np.isfinite(reject_vec) | (flat_vec > 0)
+            self._proj_params = (projector, reject_vec,
+                                 bool(np.all(unprojected[checked])))
+        return self._proj_params[2]
+
+    def _get_baseline_params(self):
+        """Get the baseline sample range and channels, cached."""
+        if self._baseline_params[0] != self.baseline:
+            # same indices as mne.baseline.rescale
+            bmin, bmax = self.baseline
+            times = self._raw_times
+            imin = 0 if bmin is None else int(np.where(times >= bmin)[0][0])
+            imax = (len(times) if bmax is None else
+                    int(np.where(times <= bmax)[0][-1]) + 1)
+            bsl_picks = getattr(self, '_detrend_picks', None)
+            if bsl_picks is not None and np.array_equal(
+                    bsl_picks, np.arange(len(self.picks))):
+                bsl_picks = None
+            self._baseline_params = (self.baseline, imin, imax, bsl_picks)
+        return self._baseline_params[1:]
+
+    def _get_reject_params(self):
+        """Get the per-channel rejection thresholds, cached."""
+        key = (self.reject, self.flat, self.info['bads'])
+        if self._reject_params[0] != key:
+            n_chan = len(self.ch_names)
+            reject_vec = np.full(n_chan, np.inf)
+            flat_vec = np.zeros(n_chan)
+            for thresholds, vec in ((self.reject, reject_vec),
+                                    (self.flat, flat_vec)):
+                if thresholds is not None:
+                    for ch_type, thresh in thresholds.items():
+                        vec[self._channel_type_idx[ch_type]] = thresh
+            bads = np.isin(self.ch_names, self.info['bads'])
+            reject_vec[bads] = np.inf
+            flat_vec[bads] = 0.
+            key = copy.deepcopy(key)
+            self._reject_params = (key, reject_vec, flat_vec)
+        return self._reject_params[1:]
 
     @verbose
     def decimate(self, decim, offset=0, verbose=None):
@@ -555,14 +980,17 @@ class RtEpochs(BaseEpochs):
 
         .. versionadded:: 0.10.0
         """
-        super(RtEpochs, self).decimate(decim, offset, verbose)
-        for i in range(len(self._epoch_queue)):
-            self._epoch_queue[i] = self._epoch_queue[i][:, self._decim_slice]
+        with self._cv:
+            super(RtEpochs, self).decimate(decim, offset, verbose)
+            # only the valid epochs are kept, in a contiguous array so that
+            # the undecimated data can be freed (no copy if decim is 1)
+            self._epoch_arr = np.ascontiguousarray(
+                self._epoch_arr[:self._n_queue, :, self._decim_slice])
         return self
 
     def __repr__(self):  # noqa: D105
         s = 'good / bad epochs received: %d / %d, epochs in queue: %d, '\
-            % (self._n_good, self._n_bad, len(self._epoch_queue))
+            % (self._n_good, self._n_bad, self._n_queue)
         s += ', tmin : %s (s)' % self.tmin
         s += ', tmax : %s (s)' % self.tmax
         s += ', baseline : %s' % str(self.baseline)
@@ -1,4 +1,6 @@
+import gc
 import os.path as op
+import threading
 import time
 
 import numpy as np
@@ -10,8 +12,10 @@ from mne import (Epochs, read_events, read_epochs, find_events, create_info,
                  pick_channels, pick_types, concatenate_raws)
 from mne.io import RawArray, read_raw_fif
 from mne.datasets import testing
+from mne.event import _find_events
 
 from mne_realtime import MockRtClient, RtEpochs
+from mne_realtime.epochs import _find_onsets
 
 base_dir = op.join(op.dirname(__file__), 'data')
 raw_fname = op.join(base_dir, 'test_raw.fif')
@@ -119,6 +123,23 @@ def test_mockclient(tmpdir):
     _call_base_epochs_public_api(rt_epochs, tmpdir)
 
 
+def test_get_data_picks():
+    """Test that picks are resolved again when the channels change."""
+    raw = read_raw_fif(raw_fname, preload=True, verbose=False)
+    picks = pick_types(raw.info, meg='grad', eeg=False, eog=True,
+                       stim=True, exclude=raw.info['bads'])
+    rt_client = MockRtClient(raw)
+    rt_epochs = RtEpochs(rt_client, 1, -0.2, 0.5, picks=picks, isi_max=0.5)
+    rt_epochs.start()
+    rt_client.send_data(rt_epochs, picks, tmin=0, tmax=10, buffer_size=1000)
+    data = rt_epochs.get_data()
+    assert_array_equal(rt_epochs.get_data(picks='eog'), data[:, [-1]])
+    rt_epochs.set_channel_types({rt_epochs.ch_names[0]: 'eog'},
+                                verbose='error')
+    assert_array_equal(rt_epochs.get_data(picks='eog'), data[:, [0, -1]])
+    rt_epochs.stop(stop_receive_thread=False)
+
+
 def test_get_event_data():
     """Test emulation of realtime data stream."""
     raw = read_raw_fif(raw_fname, preload=True, verbose=False)
@@ -267,6 +288,140 @@ def test_find_events():
         assert ii == 0
 
 
+@pytest.mark.parametrize("reject", [dict(grad=1000e-13), dict(eog=50e-6)])
+def test_fused_processing(monkeypatch, reject):
+    """Test that the fused epoch processing matches the mne helpers."""
+    raw = read_raw_fif(raw_fname, preload=True, verbose=False)
+    picks = pick_types(raw.info, meg='grad', eeg=False, eog=True,
+                       stim=True, exclude=raw.info['bads'])
+    event_id, tmin, tmax = 1, -0.2, 0.5
+
+    results = list()
+    for can_fuse in (True, False):
+        monkeypatch.setattr(RtEpochs, '_can_fuse',
+                            lambda self, can_fuse=can_fuse: can_fuse)
+        rt_client = MockRtClient(raw)
+        rt_epochs = RtEpochs(rt_client, event_id, tmin, tmax, picks=picks,
+                             reject=reject, isi_max=0.5)
+        rt_epochs.start()
+        rt_client.send_data(rt_epochs, picks, tmin=0, tmax=10,
+                            buffer_size=1000)
+        results.append((rt_epochs.get_data(), rt_epochs.drop_log))
+        rt_epochs.stop(stop_receive_thread=False)
+    assert_array_equal(results[0][0], results[1][0])
+    assert results[0][1] == results[1][1]
+
+
+class _ThreadedMockRtClient(MockRtClient):
+    """Mock client calling the callbacks from a receive thread."""
+
+    def __init__(self, raw, tmax, buffer_size):  # noqa: D102
+        super(_ThreadedMockRtClient, self).__init__(raw)
+        self._tmax_samp = int(round(self.info['sfreq'] * tmax))
+        self._buffer_size = buffer_size
+        self._recv_callbacks = list()
+        self._recv_thread = None
+
+    def register_receive_callback(self, callback):  # noqa: D102
+        self._recv_callbacks.append(callback)
+
+    def unregister_receive_callback(self, callback):  # noqa: D102
+        self._recv_callbacks.remove(callback)
+
+    def start_receive_thread(self, nchan):  # noqa: D102
+        self._recv_thread = threading.Thread(target=self._send_buffers)
+        self._recv_thread.start()
+
+    def stop_receive_thread(self, stop_measurement=False):  # noqa: D102
+        self._recv_thread.join()
+
+    def _send_buffers(self):
+        cals = np.array([[ch['range'] * ch['cal']
+                          for ch in self.info['chs']]]).T
+        data = self.raw.get_data(stop=self._tmax_samp) / cals
+        for start in range(0, self._tmax_samp, self._buffer_size):
+            for callback in list(self._recv_callbacks):
+                callback(data[:, start:start + self._buffer_size])
+
+
+def test_threaded_client():
+    """Test processing the buffers received by a receive thread."""
+    raw = read_raw_fif(raw_fname, preload=True, verbose=False)
+    picks = pick_types(raw.info, meg='grad', eeg=False, eog=True,
+                       stim=True, exclude=raw.info['bads'])
+    event_id, tmin, tmax = 1, -0.2, 0.5
+    reject = dict(grad=1000e-13)
+
+    rt_client = MockRtClient(raw)
+    rt_epochs = RtEpochs(rt_client, event_id, tmin, tmax, picks=picks,
+                         reject=reject, isi_max=0.5)
+    rt_epochs.start()
+    rt_client.send_data(rt_epochs, picks, tmin=0, tmax=10, buffer_size=1000)
+
+    th_client = _ThreadedMockRtClient(raw, tmax=10, buffer_size=1000)
+    th_epochs = RtEpochs(th_client, event_id, tmin, tmax, picks=picks,
+                         reject=reject, isi_max=0.5)
+    th_epochs.start()
+    assert th_epochs._worker.is_alive()
+    th_client._recv_thread.join()
+    # stop() processes the buffers that are still queued
+    th_epochs.stop()
+    assert th_epochs._worker is None
+    assert len(th_client._recv_callbacks) == 0
+    assert_array_equal(th_epochs.events, rt_epochs.events)
+    assert_array_equal(th_epochs.get_data(), rt_epochs.get_data())
+    assert th_epochs.drop_log == rt_epochs.drop_log
+
+    # the worker of epochs that are never stopped ends once they are collected
+    worker = rt_epochs._worker
+    del rt_epochs
+    gc.collect()
+    worker.join(5)
+    assert not worker.is_alive()
+
+
+def test_threaded_client_error(monkeypatch):
+    """Test that an error in the worker thread is raised to the user."""
+    raw = read_raw_fif(raw_fname, preload=True, verbose=False)
+    picks = pick_types(raw.info, meg='grad', eeg=False, eog=True,
+                       stim=True, exclude=raw.info['bads'])
+
+    def _raise(*args, **kwargs):
+        raise ValueError('broken epoch')
+
+    monkeypatch.setattr(RtEpochs, '_append_epoch_to_queue', _raise)
+    th_client = _ThreadedMockRtClient(raw, tmax=10, buffer_size=1000)
+    th_epochs = RtEpochs(th_client, 1, -0.2, 0.5, picks=picks, isi_max=10.)
+    th_epochs.start()
+    # the worker stops and wakes up the iteration instead of timing out
+    with pytest.raises(RuntimeError, match='Processing the received'):
+        next(th_epochs)
+    with pytest.raises(RuntimeError, match='Processing the received'):
+        th_epochs.get_data()
+    assert not th_epochs._started
+    th_epochs.stop()
+    assert th_epochs._worker is None
+    assert len(th_client._recv_callbacks) == 0
+
+
+@pytest.mark.parametrize("mask", [0, 2])
+def test_find_onsets(mask):
+    """Test the fast onset detection against _find_events."""
+    rng = np.random.RandomState(0)
+    data = np.repeat(rng.randint(-8, 8, 200), 3)[np.newaxis].astype(np.int64)
+    # a negative trigger level followed by the same positive level
+    data_sign = np.array([[-5, -5, -5, 5, 5, 5]], dtype=np.int64)
+    for this_data in (data, data_sign):
+        for first_samp in (0, 1234):
+            events = _find_events(this_data, first_samp, output='onset',
+                                  consecutive='increasing', min_samples=0,
+                                  mask=mask, mask_type='not_and',
+                                  verbose='error')
+            fast_events = _find_onsets(this_data, first_samp, np.int64(mask))
+            assert_array_equal(fast_events, events)
+    assert len(_find_onsets(data_sign, 100, np.int64(mask))) == 0
+
+
 @pytest.mark.parametrize("buffer_size", [420, 1000, 6000])
 def test_rejection(buffer_size):
     """Test rejection."""